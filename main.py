@@ -1,19 +1,66 @@
 # main.py (fixed quick-reply label <= 20 chars)
+import asyncio
+import atexit
 import base64
 import hashlib
 import hmac
-import json
+import logging
+import logging.handlers
+import math
+import operator
 import os
+import queue
 import re
 import random
-from typing import Any, Dict, List, Optional
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 import httpx
+import msgspec
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+# ── Logging ───────────────────────────────────────────────────────────────────
+# ฝั่ง request แค่ put record ลงคิว ส่วน format + write ไป stderr ทำใน thread ของ QueueListener
+# listener เริ่มตั้งแต่ import: warning ตอนโหลดโมดูลออกทันที แม้ไม่มี lifespan (script/test)
+logger = logging.getLogger("line-ollama-bot")
+
+def _setup_logging() -> None:
+    # worker ของ uvicorn (spawn) รันไฟล์นี้ 2 รอบ (__mp_main__ + main) ได้ module คนละตัว
+    # แต่ logger ตัวเดียวกัน → เช็คที่ logger ว่าตั้ง QueueHandler ไว้แล้วหรือยัง กัน log ซ้ำ
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in logger.handlers):
+        return
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stderr_handler)
+    listener.start()
+    # stop() เขียน log ที่ค้างในคิวออกให้หมดก่อนโปรเซสจบ (thread ของ listener เป็น daemon)
+    atexit.register(listener.stop)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+
+_setup_logging()
+
+# uvicorn โหลดแอปจาก "main:app" เสมอ: รอบ __main__ (python main.py) แค่สั่ง uvicorn.run
+# และรอบ __mp_main__ แค่ unpickle target ของ worker → warning ตอน import ให้รอบ main พูดครั้งเดียว
+_WARN_AT_IMPORT = __name__ not in ("__main__", "__mp_main__")
 
 # ── ENV ───────────────────────────────────────────────────────────────────────
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434").rstrip("/")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3:8b")
+# ให้ Ollama ถือโมเดล (และ KV cache ของ system prompt) ค้างไว้นานกว่าค่า default 5 นาที
+# เช่น "30m", "-1" = ไม่ unload; ว่าง = ใช้ค่าของเซิร์ฟเวอร์
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "")
+# context window ของโมเดล (options.num_ctx); ว่าง = ใช้ค่าของเซิร์ฟเวอร์
+# ตั้งค่าเดียวกันทุก request เสมอ — ค่าต่างจากที่โหลดอยู่ทำให้ Ollama โหลดโมเดล + KV cache ใหม่
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX") or "0")
 
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
@@ -32,11 +79,79 @@ PROMPT_BASE = os.getenv(
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "350"))
 SNAPSHOT_API = os.getenv("SNAPSHOT_API", "").rstrip("/")
 
-if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
-    print("⚠️ Missing LINE env: LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET")
+# cache คำตอบ AI สำหรับคำถามสั้นที่ซ้ำกันบ่อย (วินาที; 0 = ปิด)
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "300"))
+ANSWER_CACHE_MAX_PROMPT = int(os.getenv("ANSWER_CACHE_MAX_PROMPT", "200"))
+# semantic cache: ถามต่างถ้อยคำแต่ความหมายเดียวกัน → ใช้คำตอบเดิม
+# ตั้งชื่อโมเดล embedding ของ Ollama (เช่น nomic-embed-text) เพื่อเปิดใช้; ว่าง = ปิด
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# จำนวนคำตอบที่เทียบได้: สแกนทุกครั้งที่ cache miss บน event loop (768 มิติ ~25 µs/รายการ)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "64"))
+# ต้องมีทั้งโมเดลและที่เก็บ: SIZE <= 0 = ปิด (TTLCache(maxsize=0) เก็บอะไรไม่ได้เลย)
+SEMANTIC_CACHE_ENABLED = bool(SEMANTIC_CACHE_MODEL) and SEMANTIC_CACHE_SIZE > 0
+SNAPSHOT_CACHE_TTL = int(os.getenv("SNAPSHOT_CACHE_TTL", "120"))
+# token สำหรับ POST /cache/clear (ส่งมาใน header X-Admin-Token); ว่าง = ปิด route นี้
+CACHE_ADMIN_TOKEN = os.getenv("CACHE_ADMIN_TOKEN", "")
+# เวลาสูงสุด (วินาที) นับจากรับ webhook จนต้อง reply — replyToken ใช้ได้ราว 1 นาที
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", "50"))
+# Ollama ล่ม/ยังไม่มีโมเดล → งดเรียกช่วงนี้ (วินาที; 0 = ปิด) แทนรอ timeout ทุกข้อความ
+OLLAMA_COOLDOWN = float(os.getenv("OLLAMA_COOLDOWN", "30"))
+# จำนวน event ที่ประมวลผลพร้อมกันได้สูงสุดต่อ worker
+EVENT_CONCURRENCY = int(os.getenv("EVENT_CONCURRENCY", "16"))
+# เพดานขนาด body ของ webhook (bytes) — payload จริงของ LINE เล็กกว่านี้มาก
+MAX_WEBHOOK_BODY = int(os.getenv("MAX_WEBHOOK_BODY", "524288"))
+
+if _WARN_AT_IMPORT and (not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET):
+    logger.warning("⚠️ Missing LINE env: LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET")
 
 # ── FastAPI ───────────────────────────────────────────────────────────────────
-app = FastAPI(title="LINE Internal Dashboard Bot", version="1.0.1")
+class OrjsonResponse(JSONResponse):
+    """JSON response encoded with orjson instead of the stdlib json module."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+# ── Shared HTTP clients (keep-alive pool, สร้างครั้งเดียวตอน startup) ─────────
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.line_client = httpx.AsyncClient(
+        http2=True,
+        base_url="https://api.line.me",
+        headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}", "Content-Type": "application/json"},
+        timeout=20.0,
+        limits=HTTP_LIMITS,
+    )
+    # http2 มีผลเมื่อ OLLAMA_API_URL เป็น https (เช่นผ่าน reverse proxy); http:// ใช้ HTTP/1.1 keep-alive
+    app.state.ollama_client = httpx.AsyncClient(
+        http2=True,
+        base_url=OLLAMA_API_URL,
+        headers={"Content-Type": "application/json"},
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        limits=HTTP_LIMITS,
+    )
+    # client ทั่วไป (snapshot API ฯลฯ)
+    app.state.http = httpx.AsyncClient(http2=True, timeout=60.0, limits=HTTP_LIMITS)
+    # สร้างใน lifespan เพื่อให้ผูกกับ event loop ที่รันจริง
+    app.state.event_sem = asyncio.Semaphore(EVENT_CONCURRENCY)
+    try:
+        yield
+    finally:
+        # รอ reply ที่ค้างอยู่ให้ส่งเสร็จก่อนปิด client
+        if _BG_TASKS:
+            await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+        await app.state.line_client.aclose()
+        await app.state.ollama_client.aclose()
+        await app.state.http.aclose()
+
+app = FastAPI(
+    title="LINE Internal Dashboard Bot",
+    version="1.0.1",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan,
+)
 
 @app.get("/healthz")
 async def healthz():
@@ -48,37 +163,126 @@ async def healthz():
         "has_line_secret": bool(LINE_CHANNEL_SECRET),
         "max_tokens": MAX_TOKENS,
         "snapshot_api": SNAPSHOT_API or None,
+        "ollama_cooldown_s": round(max(0.0, _ollama_cooldown_until - time.monotonic()), 1),
+        "reply_deadline_misses": _deadline_misses,
     }
 
+CACHE_ADMIN_TOKEN_BYTES = CACHE_ADMIN_TOKEN.encode("utf-8")
+
+@app.post("/cache/clear")
+async def cache_clear(x_admin_token: str = Header(None)):
+    # route เปิดบนพอร์ตเดียวกับ /callback → ไม่ตั้ง token = ปิด, token ผิด = 401
+    if not CACHE_ADMIN_TOKEN_BYTES:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode("utf-8"), CACHE_ADMIN_TOKEN_BYTES):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    # ล้าง cache ในโปรเซสนี้ (หลายเวิร์กเกอร์ต้องเรียกจนครบ หรือรอ TTL หมดเอง)
+    cleared = {"answers": len(ANSWER_CACHE), "semantic": len(SEMANTIC_CACHE), "snapshots": len(SNAPSHOT_CACHE)}
+    ANSWER_CACHE.clear()
+    SEMANTIC_CACHE.clear()
+    SNAPSHOT_CACHE.clear()
+    return OrjsonResponse({"ok": True, "cleared": cleared})
+
 # ── LINE Signature ────────────────────────────────────────────────────────────
-def verify_line_signature(body: bytes, signature: str, secret: str) -> bool:
-    mac = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
-    expected_signature = base64.b64encode(mac).decode("utf-8")
-    return hmac.compare_digest(expected_signature, signature or "")
+SECRET_BYTES = (LINE_CHANNEL_SECRET or "").encode("utf-8")
+# key คงที่ → คำนวณ inner/outer pad ไว้ครั้งเดียว แล้ว .copy() ต่อ request
+HMAC_PROTOTYPE = hmac.new(SECRET_BYTES, digestmod="sha256")
+
+# SHA-256 ควรมาจาก OpenSSL (_hashlib) ซึ่งเลือกใช้ SHA-NI เองบน CPU ที่รองรับ
+if _WARN_AT_IMPORT and hashlib.sha256.__module__ != "_hashlib":
+    logger.warning("⚠️ hashlib.sha256 is not OpenSSL-backed; webhook HMAC uses the slower builtin SHA-256")
+
+async def read_signed_body(request: Request, signature: Optional[str]) -> bytes:
+    # base64 ของ SHA-256 ยาว 44 ตัวเสมอ ความยาวผิดตัดทิ้งก่อนอ่าน body
+    if not signature or len(signature) != 44:
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    # เทียบ digest ดิบ 32 bytes แทนการ base64-encode ฝั่งเราทุกครั้ง
+    try:
+        sig = base64.b64decode(signature, validate=True)
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid signature")
+
+    # body ใหญ่เกินเพดาน → ปัดทิ้งจาก Content-Length ก่อนอ่านสักไบต์
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_WEBHOOK_BODY:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    # อ่านทีละ chunk: นับขนาดไปด้วย (กัน chunked ที่ไม่บอกความยาว) และ hash ไปพร้อมกัน
+    mac = HMAC_PROTOTYPE.copy()
+    chunks: List[bytes] = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_WEBHOOK_BODY:
+            raise HTTPException(status_code=413, detail="Payload too large")
+        mac.update(chunk)
+        chunks.append(chunk)
+
+    if not hmac.compare_digest(mac.digest(), sig):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    return b"".join(chunks)
 
 # ── Post-process: ล้าง <think> + จัดวรรคตอน + บังคับลงท้าย ───────────────
-RE_THINK = re.compile(r"<think>.*?</think>", flags=re.DOTALL | re.IGNORECASE)
+RE_SPACES = re.compile(r"[ \t]{2,}")
+RE_NEWLINES = re.compile(r"\n{3,}")
+RE_DUP_PUNCT = re.compile(r"([,\.!?])\1{1,}")
+RE_SPACE_BEFORE_PUNCT = re.compile(r"\s+([,\.!?])")
+# lookahead: ไม่ต้อง capture/คัดลอกตัวอักษรถัดไปกลับเข้า template
+RE_PUNCT_NO_SPACE = re.compile(r"([,\.!?])(?=[^\s])")
+
+def _find_tag(s: str, tag: str, start: int) -> int:
+    # หา tag แบบไม่สนตัวพิมพ์ โดยไม่ต้อง lower() ทั้งข้อความ (ไล่เฉพาะตำแหน่ง "<")
+    i = s.find("<", start)
+    while i >= 0:
+        if s[i:i + len(tag)].lower() == tag:
+            return i
+        i = s.find("<", i + 1)
+    return -1
 
 def _remove_reasoning(s: str) -> str:
-    return RE_THINK.sub("", s or "")
+    if not s:
+        return ""
+    # ส่วนใหญ่มี <think> 0-1 ก้อน → str.find + slice เร็วกว่า regex
+    start = _find_tag(s, "<think>", 0)
+    if start < 0:
+        return s
+    out: List[str] = []
+    i = 0
+    while start >= 0:
+        out.append(s[i:start])
+        end = _find_tag(s, "</think>", start)
+        if end < 0:
+            # ไม่มีปิด (num_predict หมดกลาง reasoning) → ตัดทิ้งถึงท้ายข้อความ
+            return "".join(out)
+        i = end + len("</think>")
+        start = _find_tag(s, "<think>", i)
+    out.append(s[i:])
+    return "".join(out)
 
 def _tidy_text(s: str) -> str:
-    s = re.sub(r"[ \t]{2,}", " ", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
-    s = re.sub(r"[，、]", ",", s)
-    s = re.sub(r"[。]", ".", s)
-    s = re.sub(r"([,\.!?])\1{1,}", r"\1", s)
-    s = re.sub(r"\s+([,\.!?])", r"\1", s)
-    s = re.sub(r"([,\.!?])([^\s])", r"\1 \2", s)
+    # วรรคตอนจีน/ญี่ปุ่น: str.replace สแกนแบบ memchr ใน C เร็วกว่า regex/translate กับข้อความไทย
+    s = s.replace("，", ",").replace("、", ",").replace("。", ".")
+    # ข้าม regex ที่ไม่มีทาง match (เช็ค substring ถูกกว่ามาก)
+    if "  " in s or "\t" in s:
+        s = RE_SPACES.sub(" ", s)
+    if "\n\n\n" in s:
+        s = RE_NEWLINES.sub("\n\n", s)
+    s = RE_DUP_PUNCT.sub(r"\1", s)
+    s = RE_SPACE_BEFORE_PUNCT.sub(r"\1", s)
+    s = RE_PUNCT_NO_SPACE.sub(r"\1 ", s)
     return s.strip()
 
-def _postprocess(reply: str) -> str:
-    reply = _remove_reasoning(reply)
-    reply = _tidy_text(reply)
+def _ensure_ngub(reply: str) -> str:
+    # ข้อความที่บอทประกอบเองจัดรูปไว้แล้ว → แค่บังคับลงท้าย ไม่ต้องผ่าน regex
     if not reply.endswith("งับ"):
         reply = reply.rstrip("!?. \n\r\t") + " งับ"
     return reply
 
+def _postprocess(reply: str) -> str:
+    reply = _remove_reasoning(reply)
+    reply = _tidy_text(reply)
+    return _ensure_ngub(reply)
+
 # ── Helpers: labels, replies ─────────────────────────────────────────────────
 def safe_label(label: str, limit: int = 20) -> str:
     """LINE quick-reply label must be <= 20 chars."""
@@ -86,6 +290,24 @@ def safe_label(label: str, limit: int = 20) -> str:
         return label
     return label[: limit - 1] + "…"
 
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+def safe_text(text: str, limit: int = 4900) -> str:
+    """LINE text message must be <= 5000 chars, counted in UTF-16 code units."""
+    # แต่ละตัวอักษรกินไม่เกิน 2 หน่วย → ข้อความสั้น (เคสส่วนใหญ่) ไม่ต้อง encode เลย
+    if len(text) * 2 <= limit or _utf16_len(text) <= limit:
+        return text
+    # emoji นอก BMP กิน 2 หน่วย → binary search จุดตัดที่ยาวที่สุดที่ยังไม่เกิน
+    lo, hi = 0, min(len(text), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _utf16_len(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
 def quick_reply_items(labels_texts: List[Dict[str, str]]) -> Dict[str, Any]:
     return {
         "items": [
@@ -101,49 +323,29 @@ def quick_reply_items(labels_texts: List[Dict[str, str]]) -> Dict[str, Any]:
         ]
     }
 
-async def reply_text_with_quickreply(reply_token: str, text: str, items: List[Dict[str, str]]):
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    payload = {
-        "replyToken": reply_token,
-        "messages": [{
-            "type": "text",
-            "text": text,
-            "quickReply": quick_reply_items(items)
-        }]
-    }
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        r = await client.post(url, headers=headers, json=payload)
-        if r.status_code != 200:
-            print(f"❌ LINE reply error {r.status_code}: {r.text}")
-
-async def reply_image_with_quickreply(reply_token: str, original_url: str, preview_url: Optional[str], items: List[Dict[str, str]]):
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    if not preview_url:
-        preview_url = original_url
-    payload = {
-        "replyToken": reply_token,
-        "messages": [{
-            "type": "image",
-            "originalContentUrl": original_url,
-            "previewImageUrl": preview_url,
-            "quickReply": quick_reply_items(items)
-        }]
-    }
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        r = await client.post(url, headers=headers, json=payload)
-        if r.status_code != 200:
-            print(f"❌ LINE reply image error {r.status_code}: {r.text}")
-
-async def reply_sticker(reply_token: str, package_id: str = "11537", sticker_id: str = "52002734"):
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    payload = {"replyToken": reply_token, "messages": [{"type": "sticker", "packageId": package_id, "stickerId": sticker_id}]}
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        r = await client.post(url, headers=headers, json=payload)
-        if r.status_code != 200:
-            print(f"❌ LINE reply sticker error {r.status_code}: {r.text}")
+def sticker_message(package_id: str = "11537", sticker_id: str = "52002734") -> Dict[str, Any]:
+    return {"type": "sticker", "packageId": package_id, "stickerId": sticker_id}
+
+async def reply_messages(reply_token: str, messages: List[Dict[str, Any]]):
+    """Send several messages with one replyToken (LINE allows up to 5)."""
+    # จุดเดียวที่ยิง reply API — URL/headers อยู่ใน line_client แล้ว
+    payload = {"replyToken": reply_token, "messages": messages}
+    r = await app.state.line_client.post("/v2/bot/message/reply", content=orjson.dumps(payload))
+    if r.status_code != 200:
+        logger.error("❌ LINE reply error %s: %s", r.status_code, r.text)
+
+async def reply_text_with_quickreply(reply_token: str, text: str, quick_reply: orjson.Fragment):
+    await reply_messages(reply_token, [
+        {"type": "text", "text": safe_text(text), "quickReply": quick_reply},
+    ])
+
+async def reply_image_with_quickreply(reply_token: str, original_url: str, preview_url: Optional[str], quick_reply: orjson.Fragment):
+    await reply_messages(reply_token, [{
+        "type": "image",
+        "originalContentUrl": original_url,
+        "previewImageUrl": preview_url or original_url,
+        "quickReply": quick_reply,
+    }])
 
 # ── Menus ─────────────────────────────────────────────────────────────────────
 def main_quick_items() -> List[Dict[str, str]]:
@@ -158,9 +360,6 @@ def main_quick_items() -> List[Dict[str, str]]:
         {"label": "🧩 อื่น ๆ", "text": "เมนู:อื่นๆ"},
     ]
 
-async def reply_text_with_main_quick(reply_token: str, text: str):
-    await reply_text_with_quickreply(reply_token, text, main_quick_items())
-
 def submenu_quality_items() -> List[Dict[str, str]]:
     return [
         {"label": "🏗️ ติดตั้ง", "text": "รายงานการติดตั้ง"},
@@ -184,28 +383,53 @@ def submenu_others_items() -> List[Dict[str, str]]:
         {"label": "🧪 Mock KPIs", "text": "Mock KPIs"},
     ]
 
+# quick reply ของเมนูคงที่ → serialize เป็น JSON ครั้งเดียวตอน import
+# orjson.Fragment ถูกต่อ bytes เข้า payload ตรง ๆ ไม่ต้อง encode dict ใหม่ทุกข้อความ
+MAIN_QUICK_REPLY = orjson.Fragment(orjson.dumps(quick_reply_items(main_quick_items())))
+QUALITY_QUICK_REPLY = orjson.Fragment(orjson.dumps(quick_reply_items(submenu_quality_items())))
+BB_DAILY_QUICK_REPLY = orjson.Fragment(orjson.dumps(quick_reply_items(submenu_bb_daily_items())))
+OTHERS_QUICK_REPLY = orjson.Fragment(orjson.dumps(quick_reply_items(submenu_others_items())))
+
+async def reply_text_with_main_quick(reply_token: str, text: str):
+    await reply_text_with_quickreply(reply_token, text, MAIN_QUICK_REPLY)
+
+async def reply_sticker_with_main_quick(reply_token: str, text: str):
+    # replyToken ใช้ได้ครั้งเดียว → ส่งสติ๊กเกอร์ + ข้อความพร้อมเมนูใน reply เดียว
+    await reply_messages(reply_token, [
+        sticker_message(),
+        {"type": "text", "text": safe_text(text), "quickReply": MAIN_QUICK_REPLY},
+    ])
+
 # ── Mock / Draft / Pins ──────────────────────────────────────────────────────
-def draft_summary_text() -> str:
-    from datetime import datetime, timezone, timedelta
-    th = timezone(timedelta(hours=7))
-    now = datetime.now(th)
-    date_txt = now.strftime("%d/%m/%Y")
-    return _postprocess(
+TH_TZ = timezone(timedelta(hours=7))
+
+@lru_cache(maxsize=1)
+def _draft_summary_for(day_ordinal: int) -> str:
+    # ข้อความเปลี่ยนแค่วันที่ → ประกอบครั้งเดียวต่อวัน
+    date_txt = date.fromordinal(day_ordinal).strftime("%d/%m/%Y")
+    return _ensure_ngub(
         f"สรุปสถานการณ์ประจำวัน {date_txt}\n"
         f"• ภาพรวม: การให้บริการเป็นไปตามปกติ\n"
         f"• ประเด็นเด่น: ไม่มีเหตุล่มวงกว้าง, มีรายงานปัญหาเฉพาะจุดบางพื้นที่\n"
         f"• การสื่อสาร: ทีมพร้อมอัปเดตหากมีเหตุสำคัญเพิ่มเติม"
     )
 
+def draft_summary_text() -> str:
+    return _draft_summary_for(datetime.now(TH_TZ).toordinal())
+
+MOCK_RNG = random.Random()
+MOCK_TOP_ISSUES = ("อินเทอร์เน็ตช้า", "ขัดข้องพื้นที่", "บิล/ชำระเงิน", "ตั้งค่าราวเตอร์")
+
 def mock_kpis_text() -> str:
-    total = random.randint(120, 260)
-    closed = random.randint(int(total*0.6), int(total*0.9))
-    sla = round(random.uniform(90.0, 97.5), 1)
-    mtta = random.randint(12, 28)
-    mttr = round(random.uniform(1.8, 3.2), 1)
-    csat = round(random.uniform(4.1, 4.6), 2)
-    top_issue = random.choice(["อินเทอร์เน็ตช้า", "ขัดข้องพื้นที่", "บิล/ชำระเงิน", "ตั้งค่าราวเตอร์"])
-    return _postprocess(
+    rng = MOCK_RNG
+    total = rng.randint(120, 260)
+    closed = rng.randint(int(total*0.6), int(total*0.9))
+    sla = round(rng.uniform(90.0, 97.5), 1)
+    mtta = rng.randint(12, 28)
+    mttr = round(rng.uniform(1.8, 3.2), 1)
+    csat = round(rng.uniform(4.1, 4.6), 2)
+    top_issue = rng.choice(MOCK_TOP_ISSUES)
+    return _ensure_ngub(
         "Mock KPIs (เดโม)\n"
         f"• งานรับเข้า: {total} เคส | ปิดแล้ว: {closed}\n"
         f"• SLA on-time: {sla}% | MTTA: {mtta} นาที | MTTR: {mttr} ชม.\n"
@@ -213,40 +437,61 @@ def mock_kpis_text() -> str:
         f"• อาการบ่อย: {top_issue}"
     )
 
-def pinned_links_text() -> str:
-    return _postprocess(
-        "📌 ลิงก์สำคัญ\n"
-        "• Looker (TTS): https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/B03KD\n"
-        "• Looker (SCOMS): https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/p_m4ex303otd\n"
-        "• แนวทางสื่อสารเหตุขัดข้อง: https://example.com/comm-guide\n"
-        "• เกณฑ์ SLA สรุปย่อ: https://example.com/sla-brief"
-    )
+# ลิงก์คงที่ประกอบครั้งเดียว (ห้าม tidy: จะเติมวรรคหลังจุดใน URL)
+PINNED_LINKS_TEXT = _ensure_ngub(
+    "📌 ลิงก์สำคัญ\n"
+    "• Looker (TTS): https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/B03KD\n"
+    "• Looker (SCOMS): https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/p_m4ex303otd\n"
+    "• แนวทางสื่อสารเหตุขัดข้อง: https://example.com/comm-guide\n"
+    "• เกณฑ์ SLA สรุปย่อ: https://example.com/sla-brief"
+)
 
 # ── Ollama chat (Q&A TH, เดี่ยว ๆ) ──────────────────────────────────────────
-async def ask_ollama(user_text: str) -> str:
-    url = f"{OLLAMA_API_URL}/api/chat"
-    payload = {
-        "model": OLLAMA_MODEL,
-        "messages": [
-            {"role": "system", "content": PROMPT_BASE},
-            {"role": "user", "content": user_text},
-        ],
-        "stream": False,
-        "options": {
-            "num_predict": MAX_TOKENS,
-            "temperature": 0.3,
-            "top_p": 0.9,
-        },
-    }
-    timeout = httpx.Timeout(30.0, connect=10.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
+# payload คงที่สร้างครั้งเดียว ต่อคำถามแค่สร้าง messages ใหม่ (ไม่ mutate template จึงไม่ต้อง lock)
+# system prompt ต้องคงที่และอยู่ข้อความแรกเสมอ → Ollama ใช้ KV cache ของ prefix เดิมซ้ำ
+# ไม่ต้อง prefill ใหม่ทุกคำถาม (แก้ข้อความนี้ = cache เดิมใช้ไม่ได้จนโมเดลโหลดใหม่)
+OLLAMA_SYSTEM_MESSAGE = {"role": "system", "content": PROMPT_BASE}
+OLLAMA_PAYLOAD_TEMPLATE: Dict[str, Any] = {
+    "model": OLLAMA_MODEL,
+    "messages": [OLLAMA_SYSTEM_MESSAGE],
+    "stream": True,
+    "options": {
+        "num_predict": MAX_TOKENS,
+        "temperature": 0.3,
+        "top_p": 0.9,
+    },
+}
+def _parse_keep_alive(value: str) -> Any:
+    # Ollama รับตัวเลข (วินาที) หรือ duration ที่มีหน่วย เช่น "30m"
+    # ตัวเลขต้องส่งเป็น number: string "300" / "300.0" ไม่มีหน่วย Ollama ตอบ 400
+    for cast in (int, float):
         try:
-            r = await client.post(url, json=payload)
-            r.raise_for_status()
-            data = r.json()
-        except httpx.HTTPError as e:
-            print(f"❌ Ollama HTTP error: {e}")
-            return _postprocess("ขออภัย ระบบ AI ตอบไม่ได้ชั่วคราว ลองอีกครั้งได้ไหมคะ")
+            number = cast(value)
+        except ValueError:
+            continue
+        if math.isfinite(number):
+            return number
+    return value
+
+if OLLAMA_KEEP_ALIVE:
+    OLLAMA_PAYLOAD_TEMPLATE["keep_alive"] = _parse_keep_alive(OLLAMA_KEEP_ALIVE)
+if OLLAMA_NUM_CTX > 0:
+    OLLAMA_PAYLOAD_TEMPLATE["options"]["num_ctx"] = OLLAMA_NUM_CTX
+
+# รูปแบบปกติของ /api/chat stream: {"message": {"content": ...}, "done": ...}
+class OllamaMessage(msgspec.Struct):
+    content: str = ""
+
+class OllamaChunk(msgspec.Struct):
+    message: OllamaMessage
+    done: bool = False
+
+OLLAMA_CHUNK_DECODER = msgspec.json.Decoder(OllamaChunk)
+
+class OllamaStreamError(Exception):
+    """Ollama sent {"error": ...} in the middle of a streamed reply."""
+
+def _extract_content(data: Dict[str, Any]) -> Optional[str]:
     content = None
     if isinstance(data.get("message"), dict):
         content = data["message"].get("content")
@@ -256,15 +501,187 @@ async def ask_ollama(user_text: str) -> str:
             content = last.get("content")
     if not content and "response" in data:
         content = str(data.get("response"))
+    return content
+
+OLLAMA_ERROR_TEXT = _ensure_ngub("ขออภัย ระบบ AI ตอบไม่ได้ชั่วคราว ลองอีกครั้งได้ไหมคะ")
+OLLAMA_EMPTY_TEXT = _ensure_ngub("ขออภัย ไม่พบคำตอบที่เหมาะสมค่ะ")
+
+ANSWER_CACHE: "TTLCache[str, str]" = TTLCache(maxsize=1024, ttl=ANSWER_CACHE_TTL)
+
+def _answer_cache_key(user_text: str) -> str:
+    # "สวัสดี  ", "Hello" กับ "hello" ควรได้คำตอบเดียวกัน → ยุบช่องว่าง + casefold
+    return " ".join(user_text.split()).casefold()
+
+# เก็บ (เวกเตอร์ normalize แล้ว, คำตอบ) → cosine = dot product ตรง ๆ
+SEMANTIC_CACHE: "TTLCache[str, Tuple[List[float], str]]" = TTLCache(maxsize=max(1, SEMANTIC_CACHE_SIZE), ttl=ANSWER_CACHE_TTL)
+
+async def _embed(text: str) -> Optional[List[float]]:
+    try:
+        r = await app.state.ollama_client.post(
+            "/api/embed", content=orjson.dumps({"model": SEMANTIC_CACHE_MODEL, "input": text})
+        )
+        r.raise_for_status()
+        vec = orjson.loads(r.content)["embeddings"][0]
+    except (httpx.HTTPError, orjson.JSONDecodeError, KeyError, IndexError) as e:
+        logger.warning("⚠️ Ollama embed error: %s", e)
+        return None
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+def _semantic_lookup(vec: List[float]) -> Optional[str]:
+    # สแกนเชิงเส้นด้วย Python ล้วน และรันบน event loop: ระหว่างนี้ event/webhook อื่นใน worker
+    # ต้องรอ (~1.5–2 ms ที่ 64 รายการ, ~6–9 ms ที่ 256) → คุมด้วย SEMANTIC_CACHE_SIZE
+    best, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    for other, reply in SEMANTIC_CACHE.values():
+        score = sum(map(operator.mul, vec, other))
+        if score >= best_score:
+            best, best_score = reply, score
+    return best
+
+# circuit breaker แบบง่าย: เวลาที่ (monotonic) จะกลับมาลองเรียก Ollama ได้
+_ollama_cooldown_until = 0.0
+# จำนวนงานที่ถูกตัดทิ้งเพราะเลย deadline ของ replyToken (ดูได้ที่ /healthz)
+_deadline_misses = 0
+
+def _count_deadline_miss(stage: str) -> None:
+    global _deadline_misses
+    _deadline_misses += 1
+    logger.warning("⚠️ Reply deadline exceeded (%s)", stage)
+
+def _budget(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else deadline - time.monotonic()
+
+def _trip_ollama_cooldown(e: httpx.HTTPError) -> None:
+    global _ollama_cooldown_until
+    # เฉพาะอาการที่ลองซ้ำทันทีก็ไม่หาย: ต่อไม่ติด, โมเดลไม่มี (404), กำลังโหลด/ล่ม (503)
+    dead = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or (
+        isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (404, 503)
+    )
+    if dead and OLLAMA_COOLDOWN > 0:
+        _ollama_cooldown_until = time.monotonic() + OLLAMA_COOLDOWN
+
+# คำถามที่กำลังรอคำตอบจาก Ollama อยู่ (key เดียวกับ ANSWER_CACHE)
+_OLLAMA_INFLIGHT: Dict[str, "asyncio.Future[str]"] = {}
+
+async def _stream_chat(payload: Dict[str, Any]) -> List[str]:
+    # stream แบบ NDJSON: ประกอบคำตอบทีละ chunk จนเจอ done แล้วค่อย post-process ครั้งเดียว
+    parts: List[str] = []
+    async with app.state.ollama_client.stream("POST", "/api/chat", content=orjson.dumps(payload)) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            try:
+                chunk = OLLAMA_CHUNK_DECODER.decode(line)
+                piece, done = chunk.message.content, chunk.done
+            except msgspec.ValidationError:
+                # schema อื่น (messages/response) → ไล่หาแบบ dict เดิม
+                data = orjson.loads(line)
+                if not isinstance(data, dict):
+                    continue
+                if "error" in data:
+                    raise OllamaStreamError(data["error"])
+                piece, done = _extract_content(data), bool(data.get("done"))
+            if piece:
+                parts.append(piece)
+            if done:
+                break
+    return parts
+
+async def ask_ollama(user_text: str, deadline: Optional[float] = None) -> str:
+    if ANSWER_CACHE_TTL <= 0 or len(user_text) > ANSWER_CACHE_MAX_PROMPT:
+        return await _ask_ollama(user_text, None, deadline)
+    cache_key = _answer_cache_key(user_text)
+    cached = ANSWER_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # single-flight: คำถามเดียวกันที่กำลังรอ Ollama อยู่ → รอผลชุดเดียวกัน ไม่ยิงซ้ำ
+    # (shield กันผู้รอที่ถูก cancel ไปยกเลิกงานของ request แรก)
+    inflight = _OLLAMA_INFLIGHT.get(cache_key)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    fut: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+    _OLLAMA_INFLIGHT[cache_key] = fut
+    reply = OLLAMA_ERROR_TEXT
+    try:
+        reply = await _ask_ollama(user_text, cache_key, deadline)
+        return reply
+    finally:
+        # ปล่อยผู้รอทุกคนเสมอ แม้ request แรกพัง/ถูก cancel (ได้ข้อความ error แทน)
+        del _OLLAMA_INFLIGHT[cache_key]
+        fut.set_result(reply)
+
+async def _ask_ollama(user_text: str, cache_key: Optional[str], deadline: Optional[float]) -> str:
+    # Ollama เพิ่งล่มไป → ตอบ error ทันที ไม่ต้องรอ connect/timeout ซ้ำ
+    if _ollama_cooldown_until > time.monotonic():
+        return OLLAMA_ERROR_TEXT
+    # L2: exact miss → ลองหาคำถามที่ความหมายใกล้กัน (เรียก embed สั้น ๆ แทน generate ทั้งคำตอบ)
+    # ทั้ง embed และ chat อยู่ใต้ deadline ของ replyToken เดียวกัน (โหลดโมเดล embed ครั้งแรกอาจช้า)
+    vec: Optional[List[float]] = None
+    if cache_key is not None and SEMANTIC_CACHE_ENABLED:
+        try:
+            vec = await asyncio.wait_for(_embed(cache_key), timeout=_budget(deadline))
+        except asyncio.TimeoutError:
+            _count_deadline_miss("embed")
+            return OLLAMA_ERROR_TEXT
+        if vec is not None:
+            # ไม่เขียนลง ANSWER_CACHE: match ผิดจะได้ไม่ถูกตรึงไว้กับคำถามนี้จนหมด TTL
+            similar = _semantic_lookup(vec)
+            if similar is not None:
+                return similar
+
+    payload = {
+        **OLLAMA_PAYLOAD_TEMPLATE,
+        "messages": [OLLAMA_SYSTEM_MESSAGE, {"role": "user", "content": user_text}],
+    }
+    # ตัดทิ้งเมื่อเลย deadline ของ replyToken: ตอบช้ากว่านั้นก็ส่งไม่ถึงผู้ใช้อยู่ดี
+    try:
+        parts = await asyncio.wait_for(_stream_chat(payload), timeout=_budget(deadline))
+    except asyncio.TimeoutError:
+        _count_deadline_miss("chat")
+        return OLLAMA_ERROR_TEXT
+    except (httpx.HTTPError, msgspec.DecodeError, orjson.JSONDecodeError, OllamaStreamError) as e:
+        logger.error("❌ Ollama error: %s", e)
+        if isinstance(e, httpx.HTTPError):
+            _trip_ollama_cooldown(e)
+        return OLLAMA_ERROR_TEXT
+    content = _remove_reasoning("".join(parts)).strip()
     if not content:
-        content = "ขออภัย ไม่พบคำตอบที่เหมาะสมค่ะ"
-    return _postprocess(content)
+        return OLLAMA_EMPTY_TEXT
+    reply = _ensure_ngub(_tidy_text(content))
+    # เก็บเฉพาะคำตอบจริง ไม่ cache ข้อความ error
+    if cache_key is not None:
+        ANSWER_CACHE[cache_key] = reply
+        if vec is not None:
+            SEMANTIC_CACHE[cache_key] = (vec, reply)
+    return reply
 
 # ── Snapshot helper (รองรับหลายรูปแบบ + URL-encode) ───────────────────────
+# รูป dashboard เปลี่ยนช้ากว่าระดับนาที → cache URL รูปไว้ + single-flight ต่อ URL
+SNAPSHOT_CACHE: "TTLCache[str, str]" = TTLCache(maxsize=32, ttl=SNAPSHOT_CACHE_TTL)
+_SNAPSHOT_LOCKS: Dict[str, asyncio.Lock] = {}
+
 async def get_snapshot_image_url(target_url: str) -> Optional[str]:
     if not SNAPSHOT_API:
         return None
 
+    cached = SNAPSHOT_CACHE.get(target_url)
+    if cached is not None:
+        return cached
+
+    lock = _SNAPSHOT_LOCKS.setdefault(target_url, asyncio.Lock())
+    async with lock:
+        # คนที่รอ lock อยู่อาจได้ผลจากคนแรกไปแล้ว
+        cached = SNAPSHOT_CACHE.get(target_url)
+        if cached is not None:
+            return cached
+        img = await _fetch_snapshot_image_url(target_url)
+        if img:
+            SNAPSHOT_CACHE[target_url] = img
+        return img
+
+async def _fetch_snapshot_image_url(target_url: str) -> Optional[str]:
     from urllib.parse import quote_plus
 
     # แนะนำเพิ่มพารามิเตอร์ minimal view ให้ Looker เสถียรขึ้น
@@ -275,143 +692,195 @@ async def get_snapshot_image_url(target_url: str) -> Optional[str]:
     encoded = quote_plus(target_url)
 
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            api = SNAPSHOT_API
+        client = app.state.http
+        api = SNAPSHOT_API
 
-            # กรณีที่ตั้ง SNAPSHOT_API เป็น template เช่น:
-            # "https://snap.run/snapshot?url={url}" หรือ ".../snapshot/{url}"
-            if "{url}" in api:
-                url = api.replace("{url}", encoded)
-                r = await client.get(url)
+        # กรณีที่ตั้ง SNAPSHOT_API เป็น template เช่น:
+        # "https://snap.run/snapshot?url={url}" หรือ ".../snapshot/{url}"
+        if "{url}" in api:
+            url = api.replace("{url}", encoded)
+            r = await client.get(url)
 
-            # ถ้า SNAPSHOT_API มี '?' แล้ว ให้ต่อ encoded ตรง ๆ (เหมือนที่คุณตั้งเป็น ...?url=)
-            elif "?" in api:
-                url = f"{api}{encoded}"
-                r = await client.get(url)
+        # ถ้า SNAPSHOT_API มี '?' แล้ว ให้ต่อ encoded ตรง ๆ (เหมือนที่คุณตั้งเป็น ...?url=)
+        elif "?" in api:
+            url = f"{api}{encoded}"
+            r = await client.get(url)
 
-            # ไม่งั้น fallback เป็น POST JSON {"url": "..."}
-            else:
-                r = await client.post(api, json={"url": target_url})
+        # ไม่งั้น fallback เป็น POST JSON {"url": "..."}
+        else:
+            r = await client.post(api, headers={"Content-Type": "application/json"}, content=orjson.dumps({"url": target_url}))
 
-            r.raise_for_status()
-            data = r.json()
-            # คาดหวัง {"image_url": "https://...png"} หรือ {"url": "..."}
-            return data.get("image_url") or data.get("url")
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+        # คาดหวัง {"image_url": "https://...png"} หรือ {"url": "..."}
+        return data.get("image_url") or data.get("url")
 
     except Exception as e:
-        print(f"❌ Snapshot error: {e}")
+        logger.error("❌ Snapshot error: %s", e)
         return None
 
 
-# ── Webhook ───────────────────────────────────────────────────────────────────
-@app.post("/callback")
-async def line_callback(request: Request, x_line_signature: str = Header(None)):
-    if not LINE_CHANNEL_SECRET or not LINE_CHANNEL_ACCESS_TOKEN:
-        raise HTTPException(status_code=500, detail="LINE config missing")
+# ── Webhook schema (decode ตรงเป็น struct ไม่ต้องเดิน dict) ─────────────────
+class LineMessage(msgspec.Struct):
+    type: str
+    text: Optional[str] = None
 
-    body_bytes = await request.body()
-    if not x_line_signature or not verify_line_signature(body_bytes, x_line_signature, LINE_CHANNEL_SECRET):
-        raise HTTPException(status_code=401, detail="Invalid signature")
+class LineEvent(msgspec.Struct):
+    type: str
+    replyToken: Optional[str] = None
+    message: Optional[LineMessage] = None
 
-    try:
-        payload = json.loads(body_bytes.decode("utf-8"))
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
+class WebhookPayload(msgspec.Struct):
+    events: List[LineEvent] = []
 
-    events: List[Dict[str, Any]] = payload.get("events", [])
-    for event in events:
-        etype = event.get("type")
-        reply_token = event.get("replyToken")
-        if not reply_token:
-            continue
+# ── Command handlers ──────────────────────────────────────────────────────────
+TTS_LOOKER_URL = "https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/B03KD"
+SCOMS_LOOKER_URL = "https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/p_m4ex303otd"
 
-        # follow/join: ต้อนรับด้วยสติ๊กเกอร์ + เมนูหลัก
-        if etype in {"follow", "join"}:
-            await reply_sticker(reply_token)
-            await reply_text_with_main_quick(reply_token, _postprocess("สวัสดีค่ะ เลือกเมนูด้านล่างเพื่อเริ่มใช้งานได้เลย"))
-            continue
+# Leaf actions ที่ยังไม่พร้อม (static reply)
+STATIC_WAIT_COMMANDS = frozenset({
+    "รายงานการติดตั้ง", "รายงานการแก้ไขเหตุเสีย", "เหตุเสียต่อพอร์ท",
+    "อัตราเสียซ้ำ", "SA (Datacom)", "เมนู:OutTask", "เมนู:OLT",
+    "เมนู:SwitchNT", "เมนู:Broadband", "เมนู:Datacom",
+})
 
-        # เฉพาะข้อความ
-        if etype == "message" and event.get("message", {}).get("type") == "text":
-            user_text = (event["message"]["text"] or "").strip()
-            lower = user_text.lower()
+async def _menu_quality(reply_token: str):
+    await reply_text_with_quickreply(reply_token, _ensure_ngub("เลือกหัวข้อคุณภาพบริการ รบ."), QUALITY_QUICK_REPLY)
 
-            # ทักทายทั่วไป → สติ๊กเกอร์ + เมนู
-            if lower in {"start", "เริ่ม", "สวัสดี", "hello", "hi"}:
-                await reply_sticker(reply_token)
-                await reply_text_with_main_quick(reply_token, _postprocess("ยินดีช่วยครับ เลือกเมนูด้านล่างได้เลย"))
-                continue
+async def _menu_bb_daily(reply_token: str):
+    await reply_text_with_quickreply(reply_token, _ensure_ngub("เลือกหัวข้อ Broadband Daily Report"), BB_DAILY_QUICK_REPLY)
 
-            # ── Submenus ───────────────────────────────────────────────────
-            if user_text == "เมนู:คุณภาพบริการ":
-                await reply_text_with_quickreply(reply_token, _postprocess("เลือกหัวข้อคุณภาพบริการ รบ."), submenu_quality_items())
-                continue
+async def _menu_others(reply_token: str):
+    await reply_text_with_quickreply(reply_token, _ensure_ngub("เมนูเสริม"), OTHERS_QUICK_REPLY)
 
-            if user_text == "เมนู:BB Daily":
-                await reply_text_with_quickreply(reply_token, _postprocess("เลือกหัวข้อ Broadband Daily Report"), submenu_bb_daily_items())
-                continue
+# Looker snapshots → image
+async def _reply_snapshot(reply_token: str, looker_url: str):
+    img = await get_snapshot_image_url(looker_url)
+    if img:
+        await reply_image_with_quickreply(reply_token, img, None, MAIN_QUICK_REPLY)
+    else:
+        await reply_text_with_main_quick(reply_token, "ยังแคปรูปไม่ได้ (ไม่พบ SNAPSHOT_API) งับ")
 
-            if user_text == "เมนู:อื่นๆ":
-                await reply_text_with_quickreply(reply_token, _postprocess("เมนูเสริม"), submenu_others_items())
-                continue
+async def _bb_tts(reply_token: str):
+    await _reply_snapshot(reply_token, TTS_LOOKER_URL)
 
-            # ── Leaf actions (static replies) ─────────────────────────────
-            if user_text in {
-                "รายงานการติดตั้ง", "รายงานการแก้ไขเหตุเสีย", "เหตุเสียต่อพอร์ท",
-                "อัตราเสียซ้ำ", "SA (Datacom)", "เมนู:OutTask", "เมนู:OLT",
-                "เมนู:SwitchNT", "เมนู:Broadband", "เมนู:Datacom"
-            }:
-                await reply_text_with_main_quick(reply_token, _postprocess("รอ update แปปงับ"))
-                continue
+async def _bb_scoms(reply_token: str):
+    await _reply_snapshot(reply_token, SCOMS_LOOKER_URL)
 
-            # ── Looker snapshots → image ─────────────────────────────────
-            if user_text == "BB TTS":
-                tts_url = "https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/B03KD"
-                img = await get_snapshot_image_url(tts_url)
-                if img:
-                    await reply_image_with_quickreply(reply_token, img, None, main_quick_items())
-                else:
-                    await reply_text_with_main_quick(reply_token, _postprocess("ยังแคปรูปไม่ได้ (ไม่พบ SNAPSHOT_API) งับ"))
-                continue
+# Others submenu actions
+async def _draft_summary(reply_token: str):
+    await reply_text_with_main_quick(reply_token, draft_summary_text())
 
-            if user_text == "BB SCOMS":
-                scoms_url = "https://lookerstudio.google.com/reporting/b893918e-8fff-4cdb-8847-22273278669a/page/p_m4ex303otd"
-                img = await get_snapshot_image_url(scoms_url)
-                if img:
-                    await reply_image_with_quickreply(reply_token, img, None, main_quick_items())
-                else:
-                    await reply_text_with_main_quick(reply_token, _postprocess("ยังแคปรูปไม่ได้ (ไม่พบ SNAPSHOT_API) งับ"))
-                continue
+async def _pins(reply_token: str):
+    await reply_text_with_main_quick(reply_token, PINNED_LINKS_TEXT)
 
-            # ── Others submenu actions ───────────────────────────────────
-            if user_text == "ร่างสรุปวันนี้":
-                await reply_text_with_main_quick(reply_token, draft_summary_text())
-                continue
+async def _mock_kpis(reply_token: str):
+    await reply_text_with_main_quick(reply_token, mock_kpis_text())
 
-            if user_text == "Pins":
-                await reply_text_with_main_quick(reply_token, pinned_links_text())
-                continue
+async def _qna_hint(reply_token: str):
+    await reply_text_with_main_quick(
+        reply_token,
+        _ensure_ngub("พิมพ์คำถามหรือประเด็นที่อยากให้ช่วยร่างคำตอบได้เลย (เช่น ขอร่างประกาศสั้นๆ เรื่องอินเทอร์เน็ตช้าในเขตเหนือ)")
+    )
 
-            if user_text == "Mock KPIs":
-                await reply_text_with_main_quick(reply_token, mock_kpis_text())
-                continue
+COMMAND_HANDLERS: Dict[str, Callable[[str], Awaitable[None]]] = {
+    "เมนู:คุณภาพบริการ": _menu_quality,
+    "เมนู:BB Daily": _menu_bb_daily,
+    "เมนู:อื่นๆ": _menu_others,
+    "BB TTS": _bb_tts,
+    "BB SCOMS": _bb_scoms,
+    "ร่างสรุปวันนี้": _draft_summary,
+    "Pins": _pins,
+    "Mock KPIs": _mock_kpis,
+    "Q&A": _qna_hint,
+}
 
-            if user_text == "Q&A":
-                await reply_text_with_main_quick(
-                    reply_token,
-                    _postprocess("พิมพ์คำถามหรือประเด็นที่อยากให้ช่วยร่างคำตอบได้เลย (เช่น ขอร่างประกาศสั้นๆ เรื่องอินเทอร์เน็ตช้าในเขตเหนือ)")
-                )
-                continue
+# ── Webhook ───────────────────────────────────────────────────────────────────
+GREETING_WORDS = frozenset({"start", "เริ่ม", "สวัสดี", "hello", "hi"})
+GREETING_MAX_LEN = max(len(w) for w in GREETING_WORDS)
+
+# เก็บ reference ของ background task ไว้ กัน GC เก็บทิ้งระหว่างรัน
+_BG_TASKS: Set["asyncio.Task[None]"] = set()
+
+def _on_event_done(task: "asyncio.Task[None]") -> None:
+    _BG_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Event handling error", exc_info=task.exception())
+
+async def _handle_event(event: LineEvent, deadline: float) -> None:
+    etype = event.type
+    reply_token = event.replyToken
+    if not reply_token:
+        return
+
+    # follow/join: ต้อนรับด้วยสติ๊กเกอร์ + เมนูหลัก
+    if etype in {"follow", "join"}:
+        await reply_sticker_with_main_quick(reply_token, _ensure_ngub("สวัสดีค่ะ เลือกเมนูด้านล่างเพื่อเริ่มใช้งานได้เลย"))
+        return
+
+    # เฉพาะข้อความ
+    if etype == "message" and event.message is not None and event.message.type == "text":
+        user_text = (event.message.text or "").strip()
+
+        # ทักทายทั่วไป → สติ๊กเกอร์ + เมนู (ข้อความยาวเกินคำทักทายไม่ต้อง .lower())
+        if len(user_text) <= GREETING_MAX_LEN and user_text.lower() in GREETING_WORDS:
+            await reply_sticker_with_main_quick(reply_token, _ensure_ngub("ยินดีช่วยครับ เลือกเมนูด้านล่างได้เลย"))
+            return
+
+        # ── เมนู/คำสั่งคงที่: lookup ครั้งเดียว ─────────────────────────
+        if user_text in STATIC_WAIT_COMMANDS:
+            await reply_text_with_main_quick(reply_token, "รอ update แปปงับ")
+            return
+
+        handler = COMMAND_HANDLERS.get(user_text)
+        if handler is not None:
+            await handler(reply_token)
+            return
+
+        # ── Default: ส่งให้ AI ───────────────────────────────────────
+        ai_reply = await ask_ollama(user_text, deadline)
+        await reply_text_with_main_quick(reply_token, ai_reply)
+
+async def _handle_event_bounded(event: LineEvent, deadline: float) -> None:
+    async with app.state.event_sem:
+        # รอคิวนานจน replyToken หมดอายุแล้ว → ไม่ต้องเรียก AI/LINE ให้เปล่าประโยชน์
+        if time.monotonic() >= deadline:
+            _count_deadline_miss(f"queued {event.type} event dropped")
+            return
+        await _handle_event(event, deadline)
+
+@app.post("/callback")
+async def line_callback(request: Request, x_line_signature: str = Header(None)):
+    if not LINE_CHANNEL_SECRET or not LINE_CHANNEL_ACCESS_TOKEN:
+        raise HTTPException(status_code=500, detail="LINE config missing")
+
+    body_bytes = await read_signed_body(request, x_line_signature)
+
+    try:
+        payload = msgspec.json.decode(body_bytes, type=WebhookPayload)
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
 
-            # ── Default: ส่งให้ AI ───────────────────────────────────────
-            ai_reply = await ask_ollama(user_text)
-            await reply_text_with_main_quick(reply_token, ai_reply)
+    # ตอบ 200 ให้ LINE ทันที งาน AI/reply ไปทำต่อเป็น background task
+    deadline = time.monotonic() + REPLY_DEADLINE
+    for event in payload.events:
+        task = asyncio.create_task(_handle_event_bounded(event, deadline))
+        _BG_TASKS.add(task)
+        task.add_done_callback(_on_event_done)
 
-    return {"ok": True}
+    # คืน Response ตรง ๆ เพื่อข้าม jsonable_encoder ของ FastAPI
+    return OrjsonResponse({"ok": True})
 
 # ── Local run ─────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    # loop/http = "auto" (ค่า default): มี uvloop + httptools (uvicorn[standard] บน Linux) ก็ใช้เอง
+    # ไม่มี (เช่น Windows) ก็ถอยไป asyncio/h11 แทนที่จะ crash
+    if os.getenv("ENV") == "dev":
+        uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    else:
+        # แต่ละ worker มี event loop + connection pool ของตัวเอง
+        workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 2)))
+        uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)
 